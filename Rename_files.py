@@ -1240,10 +1240,13 @@ def clean_title(title):
     title = re.sub(r"\s+", " ", title).strip()
     return title
 
-for filename in os.listdir(FOLDER):
-    if not filename.lower().endswith(".pdf"):
-        continue
+# Listed up front: renaming while scandir iterates is unspecified
+pdf_files = [
+    e.name for e in os.scandir(FOLDER)
+    if e.is_file() and e.name.lower().endswith(".pdf")
+]
 
+for filename in pdf_files:
     match = re.search(r"(\d{2}-\d{4}[A-Z]?)", filename)
     if not match:
         continue
@@ -1,25 +1,180 @@
 import os
+import re
+import mmap
 import pickle
-from typing import List, Dict, Set
+import logging
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from operator import itemgetter
+from typing import List, Dict, Set, Tuple
+import bm25s
+import numpy as np
+import requests
+import xxhash
 from dotenv import load_dotenv
 
 from langchain_core.documents import Document
 from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
 from langchain_pinecone import PineconeVectorStore
-from langchain_community.retrievers import BM25Retriever
-from langchain.chains import RetrievalQA
 from langchain_core.prompts import PromptTemplate
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableLambda, RunnablePassthrough
 from langchain_core.retrievers import BaseRetriever
 from langchain_core.callbacks import CallbackManagerForRetrieverRun
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # ===============================
 # CONFIG
 # ===============================
 INDEX_NAME = "branham-index"
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-CHUNKS_FILE = os.path.join(BASE_DIR, "sermon_chunks.pkl")
+CHUNKS_BIN = os.path.join(BASE_DIR, "chunks.bin")
+CHUNKS_LOWER_BIN = os.path.join(BASE_DIR, "chunks.lower.bin")
+CHUNKS_LOWER_OFFSETS = os.path.join(BASE_DIR, "chunks.lower.off.npy")
+CHUNKS_OFFSETS = os.path.join(BASE_DIR, "chunks.off.npy")
+CHUNKS_META = os.path.join(BASE_DIR, "chunks.meta.pkl")
+BM25_DIR = os.path.join(BASE_DIR, "bm25_index")
+
+# Single-text endpoint; cheaper quota than batchEmbedContents
+EMBED_CONTENT_URL = "https://generativelanguage.googleapis.com/v1beta/{model}:embedContent"
+
+# Hybrid fusion (Reciprocal Rank Fusion)
+BM25_K = 30
+VECTOR_K = 20
+RRF_K = 60
+FUSED_TOP_K = 30
+VECTOR_CACHE_SIZE = 512
+
+
+# ===============================
+# CHUNK STORE
+# ===============================
+class ChunkStore:
+    """
+    Read-only view over the ingest output (see ingest_master.py):
+    - chunks.bin           concatenated UTF-8 page contents
+    - chunks.off.npy       int64 byte offsets, len(store) + 1 entries
+    - chunks.lower.bin     same texts after str.lower()
+    - chunks.lower.off.npy offsets into chunks.lower.bin (Unicode
+                           lowercasing can change byte lengths)
+    - chunks.meta.pkl      list of metadata dicts
+
+    Text is sliced out of the mmap only when a chunk is accessed.
+    Pickling keeps just the paths, so workers re-mmap instead of
+    copying the corpus.
+    """
+
+    def __init__(
+        self,
+        bin_path: str = CHUNKS_BIN,
+        lower_path: str = CHUNKS_LOWER_BIN,
+        offsets_path: str = CHUNKS_OFFSETS,
+        lower_offsets_path: str = CHUNKS_LOWER_OFFSETS,
+        meta_path: str = CHUNKS_META,
+    ):
+        self.bin_path = bin_path
+        self.lower_path = lower_path
+        self.offsets_path = offsets_path
+        self.lower_offsets_path = lower_offsets_path
+        self.meta_path = meta_path
+        self._open()
+
+    def _open(self):
+        self._mm = None
+        self._lower_mm = None
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.lower_offsets = np.zeros(1, dtype=np.int64)
+        self.metadata: List[Dict] = []
+
+        if not os.path.exists(self.bin_path):
+            logger.warning(
+                "Chunk store not found at %s; local search is disabled. "
+                "Run `python ingest_master.py` to build it from sermon_chunks.pkl.",
+                self.bin_path,
+            )
+            return
+
+        self.offsets = np.load(self.offsets_path)
+        self.lower_offsets = np.load(self.lower_offsets_path)
+        with open(self.meta_path, "rb") as f:
+            self.metadata = pickle.load(f)
+
+        # mmap refuses zero-length files
+        if self.offsets[-1] > 0:
+            self._mm = self._map(self.bin_path)
+            self._lower_mm = self._map(self.lower_path)
+
+    @staticmethod
+    def _map(path: str) -> mmap.mmap:
+        with open(path, "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self) -> int:
+        return len(self.metadata)
+
+    def text(self, i: int) -> str:
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        if start == end:
+            return ""
+        return self._mm[start:end].decode("utf-8")
+
+    def keyword_ids(self, needle: str) -> List[int]:
+        """
+        Ids of chunks containing needle (case-insensitive), in store order.
+        A single regex scan over the lowercased blob; after a hit the scan
+        jumps to the next chunk, and matches spanning two chunks are ignored.
+        """
+        if self._lower_mm is None:
+            return []
+
+        pattern = re.compile(re.escape(needle.lower().encode("utf-8")))
+        ids = []
+        pos = 0
+        while True:
+            m = pattern.search(self._lower_mm, pos)
+            if m is None:
+                break
+            i = int(np.searchsorted(self.lower_offsets, m.start(), side="right")) - 1
+            if i >= len(self):
+                break
+            end = int(self.lower_offsets[i + 1])
+            if m.end() <= end:
+                ids.append(i)
+            pos = end
+        return ids
+
+    def key(self, i: int):
+        """
+        Dedup key for chunk i: the content hash assigned at ingest.
+        """
+        return self.metadata[i].get("_id", i)
+
+    def __getitem__(self, i: int) -> Document:
+        return Document(page_content=self.text(i), metadata=self.metadata[i])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getstate__(self):
+        return {
+            "bin_path": self.bin_path,
+            "lower_path": self.lower_path,
+            "offsets_path": self.offsets_path,
+            "lower_offsets_path": self.lower_offsets_path,
+            "meta_path": self.meta_path,
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+
+CHUNKS = ChunkStore()
 
 
 # ===============================
@@ -46,14 +201,135 @@ SERIES_GROUPS = {
 # HELPERS
 # ===============================
 def normalize(text: str) -> str:
+    """
+    Light normalization for substring keyword search: keeps punctuation.
+    Matching and cache keys use normalize_text.
+    """
     return text.lower().replace("_", " ").replace("-", " ").strip()
 
 
-def load_chunks() -> List[Document]:
-    if not os.path.exists(CHUNKS_FILE):
+@lru_cache(maxsize=1)
+def get_bm25() -> bm25s.BM25:
+    """
+    Index is built once at ingest (ingest_master.py); only loaded here.
+    """
+    return bm25s.BM25.load(BM25_DIR, load_corpus=False)
+
+
+def bm25_search(query: str, k: int) -> List[int]:
+    """
+    Returns chunk ids of the top-k BM25 hits, best first.
+    """
+    k = min(k, len(CHUNKS))
+    if k == 0:
         return []
-    with open(CHUNKS_FILE, "rb") as f:
-        return pickle.load(f)
+
+    tokens = bm25s.tokenize([query], show_progress=False)
+    ids, scores = get_bm25().retrieve(tokens, k=k, show_progress=False)
+    return [int(i) for i, s in zip(ids[0], scores[0]) if s > 0]
+
+
+_VECTOR_CACHE: "OrderedDict[str, Tuple[Tuple[str, Dict], ...]]" = OrderedDict()
+_VECTOR_CACHE_LOCK = threading.Lock()
+
+
+def vector_search(query: str) -> List[Document]:
+    """
+    Pinecone hits for the query as typed, cached (LRU) per normalized
+    query since the corpus is static. Returns fresh Documents so callers
+    can't mutate the cached ones.
+    """
+    key = normalize_text(query)
+    with _VECTOR_CACHE_LOCK:
+        hits = _VECTOR_CACHE.get(key)
+        if hits is not None:
+            _VECTOR_CACHE.move_to_end(key)
+
+    if hits is None:
+        docs = get_vector_store().as_retriever(
+            search_kwargs={"k": VECTOR_K}
+        ).invoke(query)
+        hits = tuple((d.page_content, d.metadata) for d in docs)
+        with _VECTOR_CACHE_LOCK:
+            _VECTOR_CACHE[key] = hits
+            if len(_VECTOR_CACHE) > VECTOR_CACHE_SIZE:
+                _VECTOR_CACHE.popitem(last=False)
+
+    return [
+        Document(page_content=text, metadata=dict(meta))
+        for text, meta in hits
+    ]
+
+
+def rrf_fuse(*rankings: List) -> List:
+    """
+    Reciprocal Rank Fusion: every ranked key list adds 1 / (RRF_K + rank)
+    to each key it contains. Returns keys best first.
+    """
+    scores: Dict = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (RRF_K + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+_HTTP = requests.Session()
+
+
+class QueryEmbeddings(GoogleGenerativeAIEmbeddings):
+    """
+    Some langchain-google-genai versions send embed_query through the
+    batch endpoint. Retrieval only ever embeds one query, so call the
+    single-text embedContent endpoint directly.
+    """
+
+    @property
+    def query_url(self) -> str:
+        model = self.model if self.model.startswith("models/") else f"models/{self.model}"
+        return EMBED_CONTENT_URL.format(model=model)
+
+    def embed_query(self, text: str, **kwargs) -> List[float]:
+        api_key = (
+            self.google_api_key.get_secret_value()
+            if self.google_api_key else os.getenv("GOOGLE_API_KEY")
+        )
+        resp = _HTTP.post(
+            self.query_url,
+            # header, not query string: keeps the key out of error
+            # messages and access logs
+            headers={"x-goog-api-key": api_key},
+            json={
+                "content": {"parts": [{"text": text}]},
+                "taskType": "RETRIEVAL_QUERY",
+            },
+            timeout=30,
+        )
+        resp.raise_for_status()
+        return resp.json()["embedding"]["values"]
+
+
+@lru_cache(maxsize=1)
+def get_vector_store() -> PineconeVectorStore:
+    embeddings = QueryEmbeddings(
+        model="models/text-embedding-004"
+    )
+    logger.info("Query embeddings via POST %s", embeddings.query_url)
+    return PineconeVectorStore(
+        index_name=INDEX_NAME,
+        embedding=embeddings
+    )
+
+
+def doc_key(d: Document):
+    """
+    Dedup key: the content hash assigned at ingest, shared by local
+    chunks and Pinecone hits. Hits without one (uploaded before ids
+    existed) get the same xxhash64 computed here, so they still match.
+    """
+    key = d.metadata.get("_id")
+    if key is not None:
+        return key
+    return xxhash.xxh64(d.page_content.encode("utf-8")).hexdigest()
 
 
 def extract_date_code(filename: str) -> str:
@@ -69,21 +345,22 @@ def messagehub_link(filename: str) -> str:
     return f"https://www.messagehub.info/en/read.do?ref_num={code}"
 
 
-
-import re
-
 STOPWORDS = {
     "the", "a", "an", "of", "in", "on", "at", "and", "to", "for", "with", "by"
 }
 
 
+_NON_ALNUM = re.compile(r"[^a-z0-9\s]")
+_WS = re.compile(r"\s+")
+_DATE_CODE_JUNK = re.compile(r"[^A-Za-z0-9-]")
+
+
 def normalize_text(text: str) -> str:
-    text = text.lower()
-    text = re.sub(r"[^a-z0-9\s]", " ", text)
-    text = re.sub(r"\s+", " ", text).strip()
-    return text
+    text = _NON_ALNUM.sub(" ", text.lower())
+    return _WS.sub(" ", text).strip()
 
 
+@lru_cache(maxsize=8192)
 def extract_sermon_title(filename: str) -> str:
     """
     '62-0909E In His Presence.pdf' → 'in his presence'
@@ -97,25 +374,33 @@ def extract_sermon_title(filename: str) -> str:
     return normalize_text(name)
 
 
-def tokenize_meaningful(text: str) -> set:
-    return {
+@lru_cache(maxsize=8192)
+def tokenize_meaningful(text: str) -> frozenset:
+    return frozenset(
         w for w in normalize_text(text).split()
         if w not in STOPWORDS and len(w) > 2
-    }
+    )
 
 
-def sermon_title_matches(user_query: str, filename: str) -> bool:
-    """
-    Match only if ALL meaningful title words exist in user query.
-    Prevents partial matches like 'presence'.
-    """
-    title_tokens = tokenize_meaningful(extract_sermon_title(filename))
-    query_tokens = tokenize_meaningful(user_query)
+# ===============================
+# SOURCE LOOKUP
+# ===============================
+# Built once from the chunk metadata so sermon / series lookups are
+# O(#sources) per query instead of re-tokenizing every chunk's filename.
+SOURCE_TO_IDS: Dict[str, List[int]] = {}
+for _i, _meta in enumerate(CHUNKS.metadata):
+    SOURCE_TO_IDS.setdefault(_meta.get("source", ""), []).append(_i)
+
+SOURCE_CODES: Dict[str, str] = {
+    src: extract_date_code(src).upper() if src else ""
+    for src in SOURCE_TO_IDS
+}
 
-    if not title_tokens:
-        return False
+SOURCE_TOKENS: Dict[str, frozenset] = {
+    src: tokenize_meaningful(extract_sermon_title(src))
+    for src in SOURCE_TO_IDS
+}
 
-    return title_tokens.issubset(query_tokens)
 
 # ===============================
 # RETRIEVER
@@ -136,8 +421,8 @@ class BranhamRetriever(BaseRetriever):
         run_manager: CallbackManagerForRetrieverRun = None
     ) -> List[Document]:
 
-        query_clean = normalize(query)
-        chunks = load_chunks()
+        query_clean = normalize_text(query)
+        chunks = CHUNKS
         results: List[Document] = []
         seen = set()
 
@@ -146,6 +431,8 @@ class BranhamRetriever(BaseRetriever):
         # -------------------------------------------------
         explicit_sermon = None
         for token in query.split():
+            # "(62-0909E)." -> "62-0909E"
+            token = _DATE_CODE_JUNK.sub("", token)
             if "-" in token and len(token) >= 7:
                 explicit_sermon = token.upper()
                 break
@@ -162,64 +449,74 @@ class BranhamRetriever(BaseRetriever):
                 is_series = True
                 break
 
+        def add_source(src: str):
+            for i in SOURCE_TO_IDS.get(src, []):
+                key = chunks.key(i)
+                if key not in seen:
+                    results.append(chunks[i])
+                    seen.add(key)
+
         # -------------------------------------------------
         # SERMON-TARGETED SEARCH
         # -------------------------------------------------
         if explicit_sermon:
-            for d in chunks:
-                src = normalize(d.metadata.get("source", ""))
-                if sermon_title_matches(explicit_sermon, src):
-                    key = d.page_content[:120]
-                    if key not in seen:
-                        results.append(d)
-                        seen.add(key)
+            # prefix match: "63-0317" covers 63-0317E and 63-0317M
+            for src, code in SOURCE_CODES.items():
+                if code.startswith(explicit_sermon):
+                    add_source(src)
 
         # -------------------------------------------------
         # SERIES SEARCH
         # -------------------------------------------------
         elif target_titles:
-            for d in chunks:
-                src = normalize(d.metadata.get("source", ""))
-                if sermon_title_matches(query, src):
-                    key = d.page_content[:120]
-                    if key not in seen:
-                        results.append(d)
-                        seen.add(key)
-        
+            for src in target_titles:
+                add_source(src)
+
+            query_tokens = tokenize_meaningful(query)
+            for src, title_tokens in SOURCE_TOKENS.items():
+                if title_tokens and title_tokens.issubset(query_tokens):
+                    add_source(src)
+
         # -------------------------------------------------
         # KEYWORD SEARCH (LOCAL)
         # -------------------------------------------------
+        bm25_by_key: Dict = {}
         if len(results) < 25:
-            bm25 = BM25Retriever.from_documents(chunks)
-            bm25.k = 60
-            for d in bm25.invoke(query):
-                key = d.page_content[:120]
-                if key not in seen:
-                    results.append(d)
-                    seen.add(key)
+            for i in bm25_search(query, BM25_K):
+                bm25_by_key.setdefault(chunks.key(i), i)
+
+        # Targeted queries already have what they need locally;
+        # skip the embedding call + Pinecone round-trip.
+        if len(results) >= 25 and (explicit_sermon or is_series):
+            return results
 
         # -------------------------------------------------
         # VECTOR SEARCH (PINECONE)
         # -------------------------------------------------
+        vec_by_key: Dict = {}
         try:
-            embeddings = GoogleGenerativeAIEmbeddings(
-                model="models/text-embedding-004"
-            )
-            store = PineconeVectorStore(
-                index_name=INDEX_NAME,
-                embedding=embeddings
-            )
-
-            vec_docs = store.as_retriever(search_kwargs={"k": 30}).invoke(query)
-            for d in vec_docs:
-                key = d.page_content[:120]
-                if key not in seen:
-                    results.append(d)
-                    seen.add(key)
+            for d in vector_search(query):
+                vec_by_key.setdefault(doc_key(d), d)
 
         except Exception:
             pass
 
+        # -------------------------------------------------
+        # HYBRID FUSION (RRF over BM25 + vector ranks)
+        # -------------------------------------------------
+        fused = 0
+        for key in rrf_fuse(list(bm25_by_key), list(vec_by_key)):
+            if fused >= FUSED_TOP_K:
+                break
+            if key in seen:
+                continue
+            if key in bm25_by_key:
+                results.append(chunks[bm25_by_key[key]])
+            else:
+                results.append(vec_by_key[key])
+            seen.add(key)
+            fused += 1
+
         return results
 
 
@@ -257,6 +554,10 @@ PROMPT = PromptTemplate(
 # ===============================
 # PUBLIC API
 # ===============================
+def format_docs(docs: List[Document]) -> str:
+    return "\n\n".join(d.page_content for d in docs)
+
+
 def get_rag_chain():
     llm = ChatGoogleGenerativeAI(
         model="gemini-2.5-flash",
@@ -266,16 +567,23 @@ def get_rag_chain():
 
     retriever = BranhamRetriever()
 
-    chain = RetrievalQA.from_chain_type(
-        llm=llm,
-        retriever=retriever,
-        chain_type="stuff",
-        return_source_documents=True,
-        chain_type_kwargs={
-            "prompt": PROMPT,
-            "document_variable_name": "context_str",
-        },
-        input_key="question",
+    answer = (
+        {
+            "context_str": itemgetter("source_documents") | RunnableLambda(format_docs),
+            "question": itemgetter("question"),
+        }
+        | PROMPT
+        | llm
+        | StrOutputParser()
+    )
+
+    # Output keys match the old RetrievalQA chain: question,
+    # source_documents, result. .stream() yields result token by token.
+    chain = (
+        RunnablePassthrough.assign(
+            source_documents=itemgetter("question") | retriever
+        )
+        .assign(result=answer)
     )
 
     return chain
@@ -290,27 +598,24 @@ def search_archives(query: str):
     docs = []
     seen = set()
 
-    chunks = load_chunks()
+    chunks = CHUNKS
     query_clean = normalize(query)
 
     # Keyword search
-    for d in chunks:
-        if query_clean in d.page_content.lower():
-            key = d.page_content[:120]
-            if key not in seen:
-                docs.append(d)
-                seen.add(key)
+    for i in chunks.keyword_ids(query_clean):
+        key = chunks.key(i)
+        if key not in seen:
+            docs.append(chunks[i])
+            seen.add(key)
 
     debug.append(f"Keyword hits: {len(docs)}")
 
     # Fallback BM25
     if len(docs) < 20:
-        bm25 = BM25Retriever.from_documents(chunks)
-        bm25.k = 50
-        for d in bm25.invoke(query):
-            key = d.page_content[:120]
+        for i in bm25_search(query, 50):
+            key = chunks.key(i)
             if key not in seen:
-                docs.append(d)
+                docs.append(chunks[i])
                 seen.add(key)
 
     debug.append(f"Total results: {len(docs)}")
@@ -1,7 +1,16 @@
 import os
+import time
+import random
 import pickle
-from typing import List, Dict, Set
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Dict, Set, Optional
+import bm25s
+import numpy as np
+import xxhash
 from dotenv import load_dotenv
+from pinecone import Pinecone
+from tqdm import tqdm
 
 from langchain_core.documents import Document
 from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
@@ -18,7 +27,24 @@ load_dotenv()
 # CONFIG
 # ===============================
 INDEX_NAME = "branham-index"
-CHUNKS_FILE = "sermon_chunks.pkl"
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CHUNKS_FILE = os.path.join(BASE_DIR, "sermon_chunks.pkl")
+
+# mmap-friendly layout read by app.ChunkStore (same BASE_DIR)
+CHUNKS_BIN = os.path.join(BASE_DIR, "chunks.bin")
+CHUNKS_LOWER_BIN = os.path.join(BASE_DIR, "chunks.lower.bin")
+CHUNKS_OFFSETS = os.path.join(BASE_DIR, "chunks.off.npy")
+CHUNKS_LOWER_OFFSETS = os.path.join(BASE_DIR, "chunks.lower.off.npy")
+CHUNKS_META = os.path.join(BASE_DIR, "chunks.meta.pkl")
+BM25_DIR = os.path.join(BASE_DIR, "bm25_index")
+
+# text-embedding-004 accepts up to 100 texts per request
+BATCH_SIZE = 100
+MAX_BACKOFF = 60
+MAX_WORKERS = 6
+MAX_RETRIES = 3
+MAX_RATE_LIMIT_RETRIES = 8
+RETRY_SLEEP = 10
 
 # ===============================
 # CANONICAL SERIES
@@ -54,6 +80,133 @@ def load_chunks() -> List[Document]:
         return pickle.load(f)
 
 
+def write_chunk_store(all_docs: List[Document]) -> None:
+    """
+    Writes page contents as one contiguous UTF-8 blob plus an int64
+    offsets array, and the metadata dicts as a small pickle sidecar.
+    chunks.lower.bin holds str.lower() of each text for keyword search;
+    Unicode lowercasing can change byte lengths, so it has its own offsets.
+    Each chunk's xxhash64 content hash is stored as metadata['_id'];
+    it is the Pinecone vector id and the retrieval dedup key.
+    """
+    offsets = [0]
+    lower_offsets = [0]
+    metas = []
+
+    with open(CHUNKS_BIN, "wb") as f, open(CHUNKS_LOWER_BIN, "wb") as f_lower:
+        for d in all_docs:
+            data = d.page_content.encode("utf-8")
+            d.metadata["_id"] = xxhash.xxh64(data).hexdigest()
+            f.write(data)
+            lower = d.page_content.lower().encode("utf-8")
+            f_lower.write(lower)
+            offsets.append(offsets[-1] + len(data))
+            lower_offsets.append(lower_offsets[-1] + len(lower))
+            metas.append(d.metadata)
+
+    np.save(CHUNKS_OFFSETS, np.array(offsets, dtype=np.int64))
+    np.save(CHUNKS_LOWER_OFFSETS, np.array(lower_offsets, dtype=np.int64))
+
+    with open(CHUNKS_META, "wb") as f:
+        pickle.dump(metas, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def write_bm25_index(all_docs: List[Document]) -> None:
+    """
+    Builds the sparse BM25 index once so app.py only has to load it.
+    Chunk ids in the index are positions in all_docs / the chunk store.
+    """
+    retriever = bm25s.BM25()
+    retriever.index(bm25s.tokenize([d.page_content for d in all_docs]))
+    retriever.save(BM25_DIR)
+
+
+def is_rate_limited(e: Exception) -> bool:
+    msg = str(e)
+    return (
+        getattr(e, "status", None) == 429
+        or "429" in msg
+        or "RESOURCE_EXHAUSTED" in msg
+    )
+
+
+def _upload_batch(
+    batch: List[Document],
+    embeddings: GoogleGenerativeAIEmbeddings,
+    index,
+) -> int:
+    """
+    One embed_documents call and one upsert, skipping chunks whose
+    content-hash id is already in the index (cheap resume/re-runs).
+    429s back off exponentially up to MAX_RATE_LIMIT_RETRIES times
+    (a spent daily quota won't clear); other errors get MAX_RETRIES attempts.
+    """
+    delay = 1
+    attempt = 0
+    rate_limited = 0
+    while True:
+        try:
+            ids = [d.metadata["_id"] for d in batch]
+            existing = index.fetch(ids=ids).vectors
+            todo = [d for d in batch if d.metadata["_id"] not in existing]
+            if not todo:
+                return 0
+
+            texts = [d.page_content for d in todo]
+            vectors = embeddings.embed_documents(texts)
+            index.upsert(vectors=[
+                (d.metadata["_id"], v, d.metadata | {"text": t})
+                for d, v, t in zip(todo, vectors, texts)
+            ])
+            return len(todo)
+        except Exception as e:
+            if is_rate_limited(e):
+                rate_limited += 1
+                if rate_limited > MAX_RATE_LIMIT_RETRIES:
+                    raise
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_BACKOFF)
+                continue
+            attempt += 1
+            if attempt >= MAX_RETRIES:
+                raise
+            time.sleep(RETRY_SLEEP)
+
+
+def upload_to_pinecone(all_docs: List[Document], start_index: int = 0) -> None:
+    """
+    Keeps up to MAX_WORKERS batches in flight; a failing batch
+    does not stall the others.
+    """
+    embeddings = GoogleGenerativeAIEmbeddings(
+        model="models/text-embedding-004"
+    )
+    index = Pinecone().Index(INDEX_NAME)
+
+    batch_starts = list(range(start_index, len(all_docs), BATCH_SIZE))
+    errors: List[Optional[Exception]] = [None] * len(batch_starts)
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex, \
+            tqdm(total=len(batch_starts), desc="Uploading") as pbar:
+        futures = {}
+        for idx, i in enumerate(batch_starts):
+            # jitter so workers don't hit the APIs in lockstep
+            time.sleep(random.uniform(0, 0.2))
+            batch = all_docs[i:i + BATCH_SIZE]
+            futures[ex.submit(_upload_batch, batch, embeddings, index)] = idx
+
+        for fut in as_completed(futures):
+            idx = futures[fut]
+            errors[idx] = fut.exception()
+            pbar.update(1)
+
+    failed = [idx for idx, e in enumerate(errors) if e is not None]
+    if failed:
+        first = batch_starts[failed[0]]
+        print(f"❌ {len(failed)} batches failed, resume with --start-index {first}")
+        raise errors[failed[0]]
+
+
 def extract_date_code(filename: str) -> str:
     """
     Assumes filenames start with NN-NNNNE
@@ -268,3 +421,18 @@ def search_archives(query: str):
     debug.append(f"Total results: {len(docs)}")
 
     return docs, debug
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--upload", action="store_true")
+    parser.add_argument("--start-index", type=int, default=0)
+    args = parser.parse_args()
+
+    all_docs = load_chunks()
+    write_chunk_store(all_docs)
+    write_bm25_index(all_docs)
+    print(f"Wrote {len(all_docs)} chunks to {CHUNKS_BIN} and {BM25_DIR}")
+
+    if args.upload:
+        upload_to_pinecone(all_docs, start_index=args.start_index)
@@ -1,5 +1,7 @@
 import streamlit as st
 import time
+import logging
+import itertools
 
 # ==============================
 # PAGE CONFIG
@@ -11,6 +13,14 @@ st.set_page_config(
     initial_sidebar_state="expanded",
 )
 
+# ==============================
+# LOGGING
+# ==============================
+# Entry point owns logging config (basicConfig is a no-op on reruns).
+# Only the backend's own INFO lines are raised; libraries stay at WARNING.
+logging.basicConfig(format="%(levelname)s %(name)s: %(message)s")
+logging.getLogger("app").setLevel(logging.INFO)
+
 # ==============================
 # LOAD BACKEND
 # ==============================
@@ -194,12 +204,26 @@ if mode.startswith("🗣️"):
             "content": prompt
         })
 
-        with st.spinner("Searching the tapes..."):
-            chain = load_chain()
-            response = chain.invoke({"question": prompt})
-
-        answer_text = response.get("result", "")
-        sources = response.get("source_documents", [])
+        with st.chat_message("user", avatar="👤"):
+            st.markdown(prompt)
+
+        chain = load_chain()
+        sources = []
+
+        def stream_answer():
+            for chunk in chain.stream({"question": prompt}):
+                if "source_documents" in chunk:
+                    sources[:] = chunk["source_documents"]
+                if "result" in chunk:
+                    yield chunk["result"]
+
+        # Render tokens as Gemini produces them; the spinner covers
+        # retrieval until the first token arrives
+        with st.chat_message("assistant", avatar="🦅"):
+            with st.spinner("Searching the tapes..."):
+                tokens = stream_answer()
+                first = next(tokens, "")
+            answer_text = st.write_stream(itertools.chain([first], tokens))
 
         # Save assistant message (FULLY formed)
         st.session_state.chat_history.append({